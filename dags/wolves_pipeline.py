@@ -6,17 +6,30 @@ This DAG extracts NBA data for the Minnesota Timberwolves and loads it into Snow
 Runs daily at 6 AM ET (11 UTC) starting June 1, 2025.
 """
 
-import os
-import subprocess
+import sys
+import logging
+import functools
 import snowflake.connector
+from contextlib import closing
 from datetime import datetime, timedelta
 from pathlib import Path
+from types import MappingProxyType
 
 from airflow.decorators import dag, task
 from airflow.exceptions import AirflowException
 from airflow.hooks.base import BaseHook
 
 
+log = logging.getLogger(__name__)
+
+# Make the extractor in the Astronomer include directory importable
+EXTRACTOR_DIR = Path("/usr/local/airflow/include/nba-twolves-pipeline")
+if str(EXTRACTOR_DIR) not in sys.path:
+    sys.path.append(str(EXTRACTOR_DIR))
+
+TEAM_ID = '1610612750'  # Minnesota Timberwolves
+SEASON = '2024-25'
+
 # Default arguments for the DAG
 default_args = {
     'owner': 'data-team',
@@ -28,6 +41,72 @@ default_args = {
 }
 
 
+@functools.lru_cache(maxsize=1)
+def get_snowflake_params(conn_id='snowflake_default'):
+    """
+    Resolve Snowflake connection parameters from an Airflow connection.
+    
+    Cached per process so repeated connects in one worker don't re-query the
+    Airflow metadata DB or re-evaluate the account fallbacks.
+    
+    Args:
+        conn_id (str): Airflow connection ID
+        
+    Returns:
+        MappingProxyType: Read-only connect() keyword arguments
+    """
+    # Get connection details from Airflow connection
+    snowflake_conn = BaseHook.get_connection(conn_id)
+    
+    # For Generic connection type, account might be in host or extra field
+    account = (
+        snowflake_conn.extra_dejson.get('account') or 
+        snowflake_conn.host or 
+        'bcuhkxz-yc43329'  # full account identifier from URL
+    )
+    
+    log.info("Using Snowflake account: %s", account)
+    log.debug("Connection type: %s", snowflake_conn.conn_type)
+    
+    return MappingProxyType({
+        'account': account,
+        'user': snowflake_conn.login,
+        'password': snowflake_conn.password,
+        'role': 'ACCOUNTADMIN',
+        'warehouse': 'ETL_WH',
+        'database': 'NBA',
+        'schema': 'RAW'
+    })
+
+
+def connect_snowflake():
+    """
+    Open an authenticated Snowflake session from the 'snowflake_default' Airflow connection.
+    
+    The session is kept alive and tagged so all statements from one run can share it
+    and be found together in Snowflake's query history.
+    """
+    try:
+        # Establish Snowflake connection
+        return snowflake.connector.connect(
+            **get_snowflake_params('snowflake_default'),
+            client_session_keep_alive=True,
+            session_parameters={'QUERY_TAG': 'wolves_pipeline'}
+        )
+    except Exception as e:
+        raise AirflowException(f"Failed to get Snowflake connection 'snowflake_default': {e}")
+
+
+def fetch_loaded_game_ids():
+    """
+    Return the IDs of games that are already in Snowflake.
+    """
+    with closing(connect_snowflake()) as conn, closing(conn.cursor()) as cursor:
+        cursor.execute("SELECT DISTINCT game_id FROM GAMES")
+        # game_id may be stored as a number, so restore the API's zero-padded 10-digit form
+        return {str(row[0]).zfill(10) for row in cursor.fetchall()}
+
+
 @dag(
     dag_id='wolves_pipeline',
     default_args=default_args,
@@ -42,162 +121,108 @@ def wolves_pipeline():
     DAG for extracting Timberwolves data and loading to Snowflake
     """
     
-    @task(task_id='extract_and_load_data')
-    def extract_and_load_data():
+    @task(task_id='extract_and_stage')
+    def extract_and_stage():
         """
-        Extract NBA data using wolves_extractor.py and load to Snowflake
+        Extract NBA data using wolves_extractor.py and PUT the files to the Snowflake stage
+        
+        The PUT runs in this task because the files only exist in this worker's memory.
+        
+        Returns:
+            list: One dict per destination table with new rows, with its stage directory, prefix and pattern
         """
+        # Imported here so DAG parsing doesn't pay for pandas and nba_api
+        from wolves_extractor import extract
+        
+        try:
+            seen_game_ids = fetch_loaded_game_ids()
+        except snowflake.connector.Error as e:
+            raise AirflowException(f"Snowflake error: {e}")
+        log.info("Found %d games already loaded into GAMES", len(seen_game_ids))
         
-        # Set environment variables
-        env = os.environ.copy()
-        env['TEAM_ID'] = '1610612750'
-        env['SEASON'] = '2024-25'
+        log.info("Running wolves_extractor.extract...")
+        files = extract(team_id=TEAM_ID, season=SEASON, seen_game_ids=seen_game_ids)
+        if files is None:
+            raise AirflowException("Extractor aborted - no data written. Check extractor logs above for API errors.")
         
-        # Get today's date for file path
+        # Each day's run stages under its own directory, cleared first so files left by
+        # an earlier failed run today can't be loaded alongside this run's
         today_str = datetime.now().strftime('%Y%m%d')
-        data_dir = Path(f"data/raw/{today_str}")
         
+        # Make sure the stage exists; server-side encryption spares the client the
+        # AES encryption pass over every uploaded file
+        create_stage_command = """
+        CREATE STAGE IF NOT EXISTS CSV_STAGE
+        FILE_FORMAT = (TYPE = PARQUET)
+        ENCRYPTION = (TYPE = 'SNOWFLAKE_SSE')
+        """
+        
+        # PUT each in-memory file to Snowflake stage; file_stream uploads straight from the
+        # buffer and the file:// path only names the staged file (Parquet is already compressed).
+        # The directory was just cleared, so OVERWRITE only skips the existence check.
         try:
-            # Step 1: Run wolves_extractor.py via subprocess
-            print("Running wolves_extractor.py...")
-            
-            # Get the path to the extractor script (in Astronomer include directory)
-            script_dir = Path("/usr/local/airflow/include/nba-twolves-pipeline")
-            extractor_path = script_dir / "wolves_extractor.py"
-            
-            # Change to the nba-twolves-pipeline directory to run the script
-            original_cwd = os.getcwd()
-            os.chdir(script_dir)
-            
-            # Run the extractor
-            print(f"Current working directory before running extractor: {os.getcwd()}")
-            result = subprocess.run(
-                ['python', 'wolves_extractor.py'],
-                env=env,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            
-            print(f"Extractor output: {result.stdout}")
-            if result.stderr:
-                print(f"Extractor stderr: {result.stderr}")
-            
-            # Check if files were created
-            expected_data_dir = Path(f"data/raw/{today_str}")
-            print(f"Checking for files in: {expected_data_dir}")
-            print(f"Directory exists: {expected_data_dir.exists()}")
-            if expected_data_dir.exists():
-                files_in_dir = list(expected_data_dir.iterdir())
-                print(f"Files in data directory: {files_in_dir}")
-                
-                # Check if required files exist
-                required_files = ['games.csv', 'player_stats.csv']
-                missing_files = []
-                for file_name in required_files:
-                    file_path = expected_data_dir / file_name
-                    if not file_path.exists():
-                        missing_files.append(file_name)
-                
-                if missing_files:
-                    raise AirflowException(f"Extractor failed to create required files: {missing_files}")
-            else:
-                raise AirflowException("Extractor failed - no data directory created. Check extractor logs above for API errors.")
-            
-            # Change back to original directory
-            os.chdir(original_cwd)
-            
-            # Step 2: Connect to Snowflake
-            print("Connecting to Snowflake...")
-            
-            try:
-                # Get connection details from Airflow connection
-                snowflake_conn = BaseHook.get_connection('snowflake_default')
-                
-                # For Generic connection type, account might be in host or extra field
-                account = (
-                    snowflake_conn.extra_dejson.get('account') or 
-                    snowflake_conn.host or 
-                    'bcuhkxz-yc43329'  # full account identifier from URL
-                )
-                
-                print(f"Using Snowflake account: {account}")
-                print(f"Connection type: {snowflake_conn.conn_type}")
-                
-                # Establish Snowflake connection
-                conn = snowflake.connector.connect(
-                    account=account,
-                    user=snowflake_conn.login,
-                    password=snowflake_conn.password,
-                    role='ACCOUNTADMIN',
-                    warehouse='ETL_WH',
-                    database='NBA',
-                    schema='RAW'
-                )
-            except Exception as e:
-                raise AirflowException(f"Failed to get Snowflake connection 'snowflake_default': {e}")
-            
-            cursor = conn.cursor()
-            
-            # Step 3: Process each CSV file (games and player_stats)
-            file_names = ['games', 'player_stats']
-            table_mapping = {
-                'games': 'GAMES',
-                'player_stats': 'PLAYER_STATS'
+            with closing(connect_snowflake()) as conn, closing(conn.cursor()) as cursor:
+                cursor.execute(create_stage_command)
+                cursor.execute(f"REMOVE @CSV_STAGE/{today_str}/")
+                for name, buffer in files.items():
+                    log.info("Executing PUT command for %s...", name)
+                    cursor.execute(f"PUT 'file://{name}' @CSV_STAGE/{today_str}/ AUTO_COMPRESS=FALSE OVERWRITE=TRUE", file_stream=buffer)
+                    put_result = cursor.fetchall()
+                    log.debug("PUT result for %s: %s", name, put_result)
+        except snowflake.connector.Error as e:
+            raise AirflowException(f"Snowflake error: {e}")
+        
+        # COPY loads every matching staged file in one statement, listing only the stage
+        # prefix and filtering it with the regex; tables with no new rows are skipped
+        tables = [
+            {
+                'name': 'games',
+                'table': 'GAMES',
+                'stage_dir': today_str,
+                'stage_prefix': 'games',
+                'stage_pattern': '.*games[.]parquet'
+            },
+            {
+                'name': 'player_stats',
+                'table': 'PLAYER_STATS',
+                'stage_dir': today_str,
+                'stage_prefix': 'player_stats',
+                'stage_pattern': '.*player_stats[.]parquet'
             }
-            
-            for file_name in file_names:
-                print(f"Processing {file_name}.csv...")
-                
-                # Construct full file path
-                csv_file_path = script_dir / "data" / "raw" / today_str / f"{file_name}.csv"
-                
-                # Verify file exists
-                if not csv_file_path.exists():
-                    raise AirflowException(f"Expected CSV file not found: {csv_file_path}")
-                
-                # Step 4: PUT file to Snowflake stage
-                put_command = f"""
-                PUT file://{csv_file_path.as_posix()} @CSV_STAGE 
-                AUTO_COMPRESS=TRUE
-                """
-                
-                print(f"Executing PUT command for {file_name}...")
-                cursor.execute(put_command)
-                put_result = cursor.fetchall()
-                print(f"PUT result for {file_name}: {put_result}")
-                
-                # Step 5: COPY INTO table from staged file
-                table_name = table_mapping[file_name]
-                copy_command = f"""
-                COPY INTO {table_name}
-                FROM @CSV_STAGE/{csv_file_path.name}.gz
-                FILE_FORMAT = CSV_FMT
-                FORCE = TRUE
-                ON_ERROR = 'ABORT_STATEMENT'
-                """
-                
-                print(f"Executing COPY INTO command for {table_name}...")
+        ]
+        return [file_info for file_info in tables if f"{file_info['name']}.parquet" in files]
+    
+    @task(task_id='copy_into')
+    def copy_into(file_info):
+        """
+        COPY one table's staged Parquet files into its Snowflake table
+        """
+        # COPY INTO table from all matching staged files in one statement
+        table_name = file_info['table']
+        copy_command = f"""
+        COPY INTO {table_name}
+        FROM @CSV_STAGE/{file_info['stage_dir']}/{file_info['stage_prefix']}
+        PATTERN = '{file_info['stage_pattern']}'
+        FILE_FORMAT = (TYPE = PARQUET)
+        MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+        FORCE = TRUE
+        PURGE = TRUE
+        ON_ERROR = 'ABORT_STATEMENT'
+        """
+        
+        try:
+            with closing(connect_snowflake()) as conn, closing(conn.cursor()) as cursor:
+                log.info("Executing COPY INTO command for %s...", table_name)
                 cursor.execute(copy_command)
                 copy_result = cursor.fetchall()
-                print(f"COPY INTO result for {table_name}: {copy_result}")
-            
-            # Close Snowflake connection
-            cursor.close()
-            conn.close()
-            
-            print("Successfully completed data extraction and loading to Snowflake!")
-            
-        except subprocess.CalledProcessError as e:
-            raise AirflowException(f"wolves_extractor.py failed: {e.stdout}\n{e.stderr}")
+                log.info("COPY INTO result for %s: %s", table_name, copy_result)
         except snowflake.connector.Error as e:
             raise AirflowException(f"Snowflake error: {e}")
-        except Exception as e:
-            raise AirflowException(f"Unexpected error: {e}")
     
-    # Define task dependencies
-    extract_and_load_data()
+    # Define task dependencies: files are staged on the worker that extracted them,
+    # then each table is loaded by its own mapped task instance
+    copy_into.expand(file_info=extract_and_stage())
 
 
 # Instantiate the DAG
-dag_instance = wolves_pipeline() 
\ No newline at end of file
+dag_instance = wolves_pipeline()
\ No newline at end of file
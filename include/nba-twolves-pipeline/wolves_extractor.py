@@ -3,24 +3,177 @@
 Minnesota Timberwolves Data Extractor
 
 This script extracts the Minnesota Timberwolves NBA schedule and per-player box scores
-for the specified season, saving the results as CSV files in the data/raw directory.
+for the specified season as Parquet. The Airflow DAG stages the in-memory files from
+extract() directly; run as a script, they are saved in the given output directory.
 
 Usage:
-    python wolves_extractor.py
+    python wolves_extractor.py [--output-dir DIR]
+
+    DIR defaults to data/raw/YYYYMMDD (today's date) next to this script.
 
 Environment Variables:
     TEAM_ID: NBA team ID (default: 1610612750 for Timberwolves)
     SEASON: NBA season in format YYYY-YY (default: 2024-25)
 """
 
+import io
 import os
 import time
+import logging
+import argparse
+import threading
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import date
 from nba_api.stats.endpoints import TeamGameLog, BoxScoreTraditionalV2
 
 
+log = logging.getLogger(__name__)
+
+# Box score fetching: concurrent workers share one global request budget
+MAX_WORKERS = 6
+REQUESTS_PER_SECOND = 1.5
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 2.0
+
+# Parquet page codec; files are staged as-is, so this is the only compression applied
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_COMPRESSION_LEVEL = 3
+
+# Every column each endpoint returns, mapped to its output name. These are the
+# columns of the GAMES and PLAYER_STATS tables, so none can be left out.
+_GAMES_RENAME = {
+    'Team_ID': 'Team_ID',
+    'Game_ID': 'game_id',
+    'GAME_DATE': 'game_date',
+    'MATCHUP': 'matchup',
+    'WL': 'result',
+    'W': 'wins',
+    'L': 'losses',
+    'W_PCT': 'W_PCT',
+    'MIN': 'MIN',
+    'FGM': 'FGM',
+    'FGA': 'FGA',
+    'FG_PCT': 'team_fg_pct',
+    'FG3M': 'FG3M',
+    'FG3A': 'FG3A',
+    'FG3_PCT': 'FG3_PCT',
+    'FTM': 'FTM',
+    'FTA': 'FTA',
+    'FT_PCT': 'team_ft_pct',
+    'OREB': 'OREB',
+    'DREB': 'DREB',
+    'REB': 'team_rebounds',
+    'AST': 'team_assists',
+    'STL': 'STL',
+    'BLK': 'BLK',
+    'TOV': 'team_turnovers',
+    'PF': 'PF',
+    'PTS': 'team_points'
+}
+
+_BOX_RENAME = {
+    'GAME_ID': 'game_id',
+    'TEAM_ID': 'team_id',
+    'TEAM_ABBREVIATION': 'team_abbr',
+    'TEAM_CITY': 'TEAM_CITY',
+    'PLAYER_ID': 'player_id',
+    'PLAYER_NAME': 'player_name',
+    'NICKNAME': 'NICKNAME',
+    'START_POSITION': 'START_POSITION',
+    'COMMENT': 'COMMENT',
+    'MIN': 'minutes',
+    'FGM': 'fg_made',
+    'FGA': 'fg_attempts',
+    'FG_PCT': 'fg_pct',
+    'FG3M': 'fg3_made',
+    'FG3A': 'fg3_attempts',
+    'FG3_PCT': 'fg3_pct',
+    'FTM': 'ft_made',
+    'FTA': 'ft_attempts',
+    'FT_PCT': 'ft_pct',
+    'OREB': 'offensive_rebounds',
+    'DREB': 'defensive_rebounds',
+    'REB': 'total_rebounds',
+    'AST': 'assists',
+    'STL': 'steals',
+    'BLK': 'blocks',
+    'TO': 'turnovers',
+    'PF': 'PF',
+    'PTS': 'points',
+    'PLUS_MINUS': 'PLUS_MINUS'
+}
+
+# Arrow schema for the games file; pyarrow casts straight to these compact types on write
+_GAMES_SCHEMA = pa.schema([
+    ('Team_ID', pa.int64()),
+    ('game_id', pa.string()),
+    ('game_date', pa.string()),
+    ('matchup', pa.string()),
+    ('result', pa.string()),
+    ('wins', pa.int16()),
+    ('losses', pa.int16()),
+    ('W_PCT', pa.float32()),
+    ('MIN', pa.int16()),
+    ('FGM', pa.int16()),
+    ('FGA', pa.int16()),
+    ('team_fg_pct', pa.float32()),
+    ('FG3M', pa.int16()),
+    ('FG3A', pa.int16()),
+    ('FG3_PCT', pa.float32()),
+    ('FTM', pa.int16()),
+    ('FTA', pa.int16()),
+    ('team_ft_pct', pa.float32()),
+    ('OREB', pa.int16()),
+    ('DREB', pa.int16()),
+    ('team_rebounds', pa.int16()),
+    ('team_assists', pa.int16()),
+    ('STL', pa.int16()),
+    ('BLK', pa.int16()),
+    ('team_turnovers', pa.int16()),
+    ('PF', pa.int16()),
+    ('team_points', pa.int16())
+])
+
+# Arrow schema each box score is converted to on arrival, so every game carries the same
+# compact column types; counts are nullable since DNP rows have no stats
+_BOX_SCHEMA = pa.schema([
+    ('game_id', pa.string()),
+    ('team_id', pa.int64()),
+    ('team_abbr', pa.string()),
+    ('TEAM_CITY', pa.string()),
+    ('player_id', pa.int64()),
+    ('player_name', pa.string()),
+    ('NICKNAME', pa.string()),
+    ('START_POSITION', pa.string()),
+    ('COMMENT', pa.string()),
+    ('minutes', pa.string()),
+    ('fg_made', pa.int16()),
+    ('fg_attempts', pa.int16()),
+    ('fg_pct', pa.float32()),
+    ('fg3_made', pa.int16()),
+    ('fg3_attempts', pa.int16()),
+    ('fg3_pct', pa.float32()),
+    ('ft_made', pa.int16()),
+    ('ft_attempts', pa.int16()),
+    ('ft_pct', pa.float32()),
+    ('offensive_rebounds', pa.int16()),
+    ('defensive_rebounds', pa.int16()),
+    ('total_rebounds', pa.int16()),
+    ('assists', pa.int16()),
+    ('steals', pa.int16()),
+    ('blocks', pa.int16()),
+    ('turnovers', pa.int16()),
+    ('PF', pa.int16()),
+    ('points', pa.int16()),
+    ('PLUS_MINUS', pa.int16())
+])
+
+
 def fetch_games(team_id, season):
     """
     Fetch all games for the specified team and season.
@@ -32,171 +185,256 @@ def fetch_games(team_id, season):
     Returns:
         DataFrame: A pandas DataFrame containing the game data
     """
-    print(f"Fetching games for team ID {team_id} in {season} season...")
+    log.info("Fetching games for team ID %s in %s season...", team_id, season)
     
     try:
         # Call the TeamGameLog endpoint
         game_log = TeamGameLog(team_id=team_id, season=season)
         games_df = game_log.get_data_frames()[0]
-        print(f"Successfully fetched game log with {len(games_df)} games")
+        log.info("Successfully fetched game log with %d games", len(games_df))
         
         # Keep only necessary columns and rename for clarity
-        games_df = games_df.rename(columns={
-            'Game_ID': 'game_id',
-            'GAME_DATE': 'game_date',
-            'MATCHUP': 'matchup',
-            'WL': 'result',
-            'W': 'wins',
-            'L': 'losses',
-            'PTS': 'team_points',
-            'FG_PCT': 'team_fg_pct',
-            'FT_PCT': 'team_ft_pct',
-            'REB': 'team_rebounds',
-            'AST': 'team_assists',
-            'TOV': 'team_turnovers'
-        })
+        games_df = games_df[list(_GAMES_RENAME)].rename(columns=_GAMES_RENAME)
         
         return games_df
     except Exception as e:
-        print(f"ERROR in fetch_games: {e}")
+        log.error("fetch_games failed: %s", e)
         return pd.DataFrame()
 
 
-def fetch_boxscores(game_ids):
+class RateLimiter:
     """
-    Fetch box scores for a list of game IDs.
+    Leaky-bucket rate limiter shared by all box score worker threads.
     
-    Args:
-        game_ids (list): List of NBA game IDs
-        
-    Returns:
-        DataFrame: A pandas DataFrame containing player stats from all games
+    Each call to acquire() reserves the next free slot on a global schedule,
+    so requests are spaced at least 1/rate seconds apart no matter how many
+    threads are issuing them.
     """
-    print(f"Fetching box scores for {len(game_ids)} games...")
     
-    all_player_stats = []
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
     
-    for i, game_id in enumerate(game_ids):
-        print(f"Processing game {i+1}/{len(game_ids)}: {game_id}")
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
         
+        wait = slot - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+def fetch_boxscore(game_id, rate_limiter):
+    """
+    Fetch the box score for a single game, retrying on network errors.
+    
+    Args:
+        game_id (str): The NBA game ID
+        rate_limiter (RateLimiter): Limiter shared across all worker threads
+        
+    Returns:
+        DataFrame: A pandas DataFrame containing player stats for the game
+    """
+    for attempt in range(1, MAX_RETRIES + 1):
+        rate_limiter.acquire()
         try:
             # Call the BoxScoreTraditionalV2 endpoint
             box_score = BoxScoreTraditionalV2(game_id=game_id)
             player_stats = box_score.get_data_frames()[0]
             
-            # Add game_id to the player stats
-            player_stats['game_id'] = game_id
-            
-            # Append to the list
-            all_player_stats.append(player_stats)
-            print(f"  ✓ Game {i+1}: Added {len(player_stats)} player records")
-            
-            # Sleep to respect rate limits (at least 0.6s between calls)
-            if i < len(game_ids) - 1:
-                time.sleep(0.6)
-        except Exception as e:
-            print(f"  ✗ ERROR processing game {game_id}: {e}")
+            # Select and rename the table's columns before the frame is held for concatenation
+            return player_stats[list(_BOX_RENAME)].rename(columns=_BOX_RENAME)
+        except requests.exceptions.RequestException as e:
+            if attempt == MAX_RETRIES:
+                raise
+            backoff = RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1)
+            log.warning("Game %s: attempt %d failed (%s), retrying in %.1fs", game_id, attempt, e, backoff)
+            time.sleep(backoff)
+
+
+def fetch_boxscores(game_ids):
+    """
+    Fetch box scores for a list of game IDs.
     
-    # Concatenate all player stats into a single DataFrame
-    if all_player_stats:
-        print(f"Concatenating {len(all_player_stats)} game box scores...")
-        player_stats_df = pd.concat(all_player_stats, ignore_index=True)
+    Requests are issued from a bounded thread pool so their network latency
+    overlaps, while a shared rate limiter keeps the overall request rate
+    within NBA API limits. Each box score is converted to a compact Arrow
+    table as it arrives, so the wide pandas frames are never held together.
+    
+    Args:
+        game_ids (list): List of NBA game IDs
         
-        # Rename columns for clarity
-        player_stats_df = player_stats_df.rename(columns={
-            'PLAYER_ID': 'player_id',
-            'PLAYER_NAME': 'player_name',
-            'TEAM_ID': 'team_id',
-            'TEAM_ABBREVIATION': 'team_abbr',
-            'MIN': 'minutes',
-            'PTS': 'points',
-            'FGM': 'fg_made',
-            'FGA': 'fg_attempts',
-            'FG_PCT': 'fg_pct',
-            'FG3M': 'fg3_made',
-            'FG3A': 'fg3_attempts',
-            'FG3_PCT': 'fg3_pct',
-            'FTM': 'ft_made',
-            'FTA': 'ft_attempts',
-            'FT_PCT': 'ft_pct',
-            'OREB': 'offensive_rebounds',
-            'DREB': 'defensive_rebounds',
-            'REB': 'total_rebounds',
-            'AST': 'assists',
-            'STL': 'steals',
-            'BLK': 'blocks',
-            'TO': 'turnovers'
-        })
+    Returns:
+        Table: A pyarrow Table containing player stats from all games,
+            or None if every request failed
+    """
+    log.info("Fetching box scores for %d games...", len(game_ids))
+    
+    rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+    # Bound the number of queued games so submissions don't run far ahead of the workers
+    slots = threading.Semaphore(MAX_WORKERS * 2)
+    results = [None] * len(game_ids)
+    
+    # A daily run usually has only a game or two, so don't start idle workers
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(game_ids)))) as executor:
+        futures = {}
+        for i, game_id in enumerate(game_ids):
+            slots.acquire()
+            future = executor.submit(fetch_boxscore, game_id, rate_limiter)
+            future.add_done_callback(lambda _: slots.release())
+            futures[future] = i
         
-        return player_stats_df
+        for future in as_completed(futures):
+            i = futures[future]
+            game_id = game_ids[i]
+            try:
+                player_stats = future.result()
+                results[i] = pa.Table.from_pandas(player_stats, schema=_BOX_SCHEMA, preserve_index=False)
+                log.debug("✓ Game %d/%d (%s): Added %d player records", i + 1, len(game_ids), game_id, len(player_stats))
+            except Exception as e:
+                log.error("✗ Failed processing game %s: %s", game_id, e)
+    
+    # Keep submission order so the output is deterministic
+    all_player_stats = [table for table in results if table is not None]
     
-    print("WARNING: No player stats data collected!")
-    return pd.DataFrame()
+    # Concatenate all player stats into a single table; this only links the per-game chunks
+    if all_player_stats:
+        log.info("Concatenating %d game box scores...", len(all_player_stats))
+        return pa.concat_tables(all_player_stats)
+    
+    log.warning("No player stats data collected!")
+    return None
 
 
-def main():
-    """
-    Main function to extract and save Timberwolves data.
+def extract(team_id='1610612750', season='2024-25', seen_game_ids=()):
     """
-    # Get team ID and season from environment variables or use defaults
-    team_id = os.environ.get('TEAM_ID', '1610612750')  # Default: Timberwolves
-    season = os.environ.get('SEASON', '2024-25')
+    Extract Timberwolves data into in-memory Parquet files.
     
-    print(f"Starting extraction with TEAM_ID={team_id}, SEASON={season}")
+    Only games not in seen_game_ids are extracted, so daily runs after the first
+    only fetch box scores for the games played since the last load.
+    
+    Args:
+        team_id (str): The NBA team ID (default: Timberwolves)
+        season (str): The NBA season in format YYYY-YY
+        seen_game_ids (iterable): Game IDs that are already loaded
+        
+    Returns:
+        dict: Parquet buffers, rewound to the start, keyed by file name (empty if
+            there are no new games), or None if extraction aborted
+    """
+    log.info("Starting extraction with TEAM_ID=%s, SEASON=%s", team_id, season)
     
     # Fetch games data
     games_df = fetch_games(team_id, season)
     
     if games_df.empty:
-        print("ERROR: No games data retrieved. Aborting.")
+        log.error("No games data retrieved. Aborting.")
         return
     
-    # Extract game IDs for box score fetching
+    # Keep only the games that are not loaded yet
+    season_games = len(games_df)
+    games_df = games_df[~games_df['game_id'].isin(set(seen_game_ids))]
     game_ids = games_df['game_id'].tolist()
-    print(f"Found {len(game_ids)} game IDs to process")
+    log.info("Found %d new game IDs to process (%d already loaded)", len(game_ids), season_games - len(game_ids))
     
-    # Fetch player stats for all games
-    player_stats_df = fetch_boxscores(game_ids)
+    if not game_ids:
+        log.info("No new games since the last load - nothing to extract")
+        return {}
     
-    if player_stats_df.empty:
-        print("ERROR: No player stats data retrieved. Aborting.")
+    # Fetch player stats for new games only
+    player_stats = fetch_boxscores(game_ids)
+    
+    if player_stats is None:
+        log.error("No player stats data retrieved. Aborting.")
         return
     
-    # Create output directory path with today's date (YYYYMMDD)
-    today_str = date.today().strftime('%Y%m%d')
-    output_dir = Path(f"data/raw/{today_str}")
+    # A game whose box score failed or is still empty is left out of both files,
+    # so it stays unloaded and the next run retries it
+    games_df = games_df[games_df['game_id'].isin(set(player_stats['game_id'].to_pylist()))]
+    if len(games_df) < len(game_ids):
+        log.warning("%d new games have no box score yet and will be retried next run", len(game_ids) - len(games_df))
     
-    # Print current working directory for debugging
-    print(f"Current working directory: {os.getcwd()}")
-    print(f"Output directory to create: {output_dir}")
+    if games_df.empty:
+        return {}
+    
+    # Write zstd-compressed Parquet without index; write failures propagate.
+    # Player stats go out in one write so the file holds a single row group, not one per game.
+    files = {'games.parquet': io.BytesIO(), 'player_stats.parquet': io.BytesIO()}
+    pq.write_table(
+        pa.Table.from_pandas(games_df, schema=_GAMES_SCHEMA, preserve_index=False),
+        files['games.parquet'],
+        compression=PARQUET_COMPRESSION,
+        compression_level=PARQUET_COMPRESSION_LEVEL
+    )
+    log.info("✓ Wrote %d rows to games.parquet", len(games_df))
+    pq.write_table(
+        player_stats,
+        files['player_stats.parquet'],
+        compression=PARQUET_COMPRESSION,
+        compression_level=PARQUET_COMPRESSION_LEVEL
+    )
+    log.info("✓ Wrote %d rows to player_stats.parquet", player_stats.num_rows)
+    
+    for buffer in files.values():
+        buffer.seek(0)
+    return files
+
+
+def main(output_dir, team_id='1610612750', season='2024-25'):
+    """
+    Main function to extract and save Timberwolves data.
+    
+    Args:
+        output_dir (Path): Directory to write the Parquet files into
+        team_id (str): The NBA team ID (default: Timberwolves)
+        season (str): The NBA season in format YYYY-YY
+        
+    Returns:
+        Path: The directory the Parquet files were written to, or None if extraction aborted
+    """
+    files = extract(team_id=team_id, season=season)
+    if files is None:
+        return
+    
+    output_dir = Path(output_dir)
+    log.debug("Output directory to create: %s", output_dir)
     
     # Create directories if they don't exist
     try:
         output_dir.mkdir(parents=True, exist_ok=True)
-        print(f"Created output directory: {output_dir}")
+        log.debug("Created output directory: %s", output_dir)
     except Exception as e:
-        print(f"ERROR creating directory {output_dir}: {e}")
+        log.error("Failed creating directory %s: %s", output_dir, e)
         return
     
-    # Write CSVs without index
-    games_csv_path = output_dir / "games.csv"
-    player_stats_csv_path = output_dir / "player_stats.csv"
+    # Write failures propagate so callers never see a partially written directory as success.
+    # getbuffer() hands the sink's memory to the write without copying it into a new bytes object.
+    for name, buffer in files.items():
+        (output_dir / name).write_bytes(buffer.getbuffer())
+        log.info("✓ Wrote %s", output_dir / name)
     
-    print(f"Writing games data to {games_csv_path}")
-    try:
-        games_df.to_csv(games_csv_path, index=False)
-        print(f"✓ Wrote {len(games_df)} rows to {games_csv_path}")
-    except Exception as e:
-        print(f"ERROR writing games CSV: {e}")
-    
-    print(f"Writing player stats data to {player_stats_csv_path}")
-    try:
-        player_stats_df.to_csv(player_stats_csv_path, index=False)
-        print(f"✓ Wrote {len(player_stats_df)} rows to {player_stats_csv_path}")
-    except Exception as e:
-        print(f"ERROR writing player stats CSV: {e}")
+    return output_dir
 
 
 if __name__ == "__main__":
-    main()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    
+    parser = argparse.ArgumentParser(description="Extract Timberwolves games and box scores to Parquet")
+    parser.add_argument(
+        '--output-dir',
+        type=Path,
+        default=Path(__file__).resolve().parent / "data" / "raw" / date.today().strftime('%Y%m%d'),
+        help="Directory to write the Parquet files into (default: data/raw/YYYYMMDD next to this script)"
+    )
+    args = parser.parse_args()
+    
+    # Get team ID and season from environment variables or use defaults
+    main(
+        args.output_dir,
+        team_id=os.environ.get('TEAM_ID', '1610612750'),  # Default: Timberwolves
+        season=os.environ.get('SEASON', '2024-25')
+    )
 